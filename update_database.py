@@ -4,18 +4,31 @@ Use the instrument risk registers in the curren folder to update the databse for
 By default, possible information from a run within the last two weeks is being deleted to allow multiple
 runs if some risk registers were delivered too late etc.
 
+Run once with --create-index to add the index on "Date Added" to the risk history table.
+
 Written by Artur Glavic (artur.glavic@psi.ch).
 """
 
+import json
 import logging
 import os
 import sys
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from glob import glob
+from itertools import islice
+from operator import itemgetter
+from zipfile import ZipFile
 
 import pyodbc
 from openpyxl import load_workbook
+from openpyxl.packaging.relationship import get_dependents, get_rels_path
+from openpyxl.reader.workbook import WorkbookParser
+from openpyxl.utils.cell import range_boundaries
 from openpyxl.worksheet.table import Table
+from openpyxl.xml.constants import ARC_WORKBOOK, REL_NS
+from openpyxl.xml.functions import fromstring
 
 
 if getattr(sys, 'frozen', False):
@@ -27,7 +40,34 @@ else:
     CUR_PATH = os.path.dirname(os.path.abspath(__file__))
 
 DATE_OVERWRITE = None  # datetime(year=2022, month=7, day=27)
-RM_TABLE = str.maketrans(dict.fromkeys('aeiouAEIOU-_ '))
+RM_BYTES = b'aeiouAEIOU-_ '
+BATCH_SIZE = 1000
+READ_AHEAD = 4  # number of workbooks parsed in the background while the current one is inserted
+# excel columns stored in the database after the project name, the table is only read up to the last one
+ROW_INDICES = (1, 2, 3, 4, 5, 6, 7, 8, 14, 15, 16, 17, 18, 19, 20, 21, 22, 24)
+USED_COLUMNS = max(ROW_INDICES)+1
+
+HISTORY_COLUMNS = ('"Date Added", Project, "Risk ID", "Global ID", "Risk Title", "Risk and Impact Description",'
+                   'Owner, Partner, Status, "Risk Treatment", "Past Treatment Actions and Notes", '
+                   '"Last Reviewed", "Planned Treatment Actions", "Action Due", '
+                   'when, cost, schedule, quality, "max impact", likelihood, "Risk Rating"')
+LATEST_COLUMNS = ('Project, "Risk ID", "Global ID", "Risk Title", "Risk and Impact Description",'
+                  'Owner, Partner, Status, "Risk Treatment", "Past Treatment Actions and Notes", '
+                  '"Last Reviewed", "Planned Treatment Actions", "Action Due", '
+                  'when, cost, schedule, quality, "max impact", likelihood, "Risk Rating", '
+                  '"Last Rating", "Full History"')
+# parameter types for fast_executemany mirror the table schema (Text(255), Memo, Date/Time, Long Integer),
+# the Access driver does not describe parameters and blank cells (None) would leave the type to the first row
+TEXT_PARAM = (pyodbc.SQL_WVARCHAR, 255, 0)
+MEMO_PARAM = (pyodbc.SQL_WLONGVARCHAR, 0, 0)
+DATE_PARAM = (pyodbc.SQL_TYPE_TIMESTAMP, 19, 0)
+INT_PARAM = (pyodbc.SQL_INTEGER, 0, 0)
+LATEST_TYPES = [TEXT_PARAM, INT_PARAM, TEXT_PARAM, TEXT_PARAM, MEMO_PARAM,
+                TEXT_PARAM, TEXT_PARAM, TEXT_PARAM, TEXT_PARAM, MEMO_PARAM,
+                DATE_PARAM, MEMO_PARAM, DATE_PARAM,
+                INT_PARAM, INT_PARAM, INT_PARAM, INT_PARAM, INT_PARAM, INT_PARAM, INT_PARAM,
+                INT_PARAM, MEMO_PARAM]
+HISTORY_TYPES = [DATE_PARAM]+LATEST_TYPES[:20]
 
 
 def handle_exception(exc_type, exc_value, exc_traceback):
@@ -55,19 +95,58 @@ def setup_logging():
     logging.debug('Started logging for update_databse script, (artur.glavic@psi.ch)')
 
 
+def read_table(fname, sheet_name, name):
+    # read-only workbooks do not expose tables, so resolve the definition through the sheet relationships
+    with ZipFile(fname) as zf:
+        parser = WorkbookParser(zf, ARC_WORKBOOK, keep_links=False)
+        parser.parse()
+        for sheet, rel in parser.find_sheets():
+            rels_path = get_rels_path(rel.target)
+            if sheet.name!=sheet_name or rels_path not in zf.namelist():
+                continue
+            for tbl_rel in get_dependents(zf, rels_path).find(REL_NS+'/table'):
+                tbl = Table.from_tree(fromstring(zf.read(tbl_rel.target)))
+                if tbl.name==name:
+                    return tbl
+    raise KeyError(f'No table {name} on sheet {sheet_name} in {fname}')
+
+
 def read_excel(fname):
     logging.info(f'Read risk data from {fname}')
-    wb = load_workbook(filename=fname, data_only=True)
-    tbl: Table = wb['Risks'].tables['Risk_Reg']
-    data = [[ci.value for ci in ri] for ri in wb['Risks'][tbl.ref]]
-    logging.debug(f'  found {len(data)-tbl.headerRowCount} rows')
-    return tbl.column_names, data[tbl.headerRowCount:]
+    tbl: Table = read_table(fname, 'Risks', 'Risk_Reg')
+    min_col, min_row, max_col, max_row = range_boundaries(tbl.ref)
+    max_col = min(max_col, min_col+USED_COLUMNS-1)
+    logging.debug(f'  table columns: {tbl.column_names}')
+    wb = load_workbook(filename=fname, data_only=True, read_only=True, keep_links=False)
+    try:
+        yield from wb['Risks'].iter_rows(min_row=min_row+(tbl.headerRowCount or 0), max_row=max_row,
+                                         min_col=min_col, max_col=max_col, values_only=True)
+    finally:
+        wb.close()
+
+
+def read_risk_files(files):
+    # parse a limited number of workbooks in parallel, so only those are held in memory at the same time,
+    # all database access stays on the main thread
+    files = iter(files)
+    with ThreadPoolExecutor(max_workers=READ_AHEAD) as ex:
+        pending = deque((fname, ex.submit(list, read_excel(fname))) for fname in islice(files, READ_AHEAD))
+        while pending:
+            fname, future = pending.popleft()
+            data = future.result()
+            for next_fname in islice(files, 1):
+                pending.append((next_fname, ex.submit(list, read_excel(next_fname))))
+            yield fname, data
 
 
 def tint(val):
+    if isinstance(val, int):
+        return val
+    if val is None:
+        return -1
     try:
         return int(val)
-    except ValueError:
+    except (ValueError, TypeError):
         return -1
 
 
@@ -78,6 +157,21 @@ def tdate(val):
         return None
 
 
+# projection of the ROW_INDICES columns and the converter applied to each
+ROW_COLUMNS = itemgetter(*ROW_INDICES)
+ROW_CONVERTERS = (tint, None, None, None, None, None, None, None,
+                  tdate, None, tdate,
+                  tint, tint, tint, tint, tint, tint, tint)
+
+
+def inst_prefix(project):
+    # project names are ASCII, deleting from bytes avoids the unicode translation table lookups
+    inst = project.encode('ascii', 'ignore').translate(None, RM_BYTES)[:3].decode('ascii')
+    if len(inst)<3:
+        inst = project[:3]
+    return inst
+
+
 def check_row_entries(di):
     problem_columns = []
     try:
@@ -85,9 +179,7 @@ def check_row_entries(di):
     except (AttributeError, ValueError, TypeError):
         problem_columns.append(0)
     for i in [1, 17, 18, 19, 20, 21, 22, 24]:
-        try:
-            tint(di[i])
-        except (AttributeError, ValueError, TypeError):
+        if tint(di[i])==-1:
             problem_columns.append(i)
     for i in [14, 16]:
         try:
@@ -97,6 +189,38 @@ def check_row_entries(di):
     logging.debug(f'    issues in columns {problem_columns}')
 
 
+def convert_rows(fname, data, now_date, inst_cache):
+    for i, di in enumerate(data):
+        try:
+            cached = inst_cache.get(di[0])
+            if cached is None:
+                project = di[0].upper()
+                cached = inst_cache[di[0]] = (project, inst_prefix(project))
+            project, inst = cached
+            if di[1] is None:
+                # the risk ID is part of the key, rows without it can't be matched to their history
+                raise ValueError('missing Risk ID')
+            values = tuple(ci(vi) if ci else vi for ci, vi in zip(ROW_CONVERTERS, ROW_COLUMNS(di)))
+            yield (now_date, project, values[0], f'{inst}-{values[0]:02}')+values[1:]
+        except (AttributeError, ValueError, TypeError):
+            logging.warning(f'  error when parsing row {i+5} of {os.path.basename(fname)}, check table')
+            logging.debug(f'    data in {fname}: {di}')
+            check_row_entries(di)
+            logging.debug('    error message:', exc_info=True)
+
+
+def create_date_index(crsr):
+    # one-time migration, lets the delete of recent entries use an index range instead of a table scan
+    leading = [si.column_name for si in crsr.statistics(table='Full Risk History')
+               if si.index_name and si.ordinal_position==1]
+    if 'Date Added' in leading:
+        logging.info('Index on "Date Added" column of risk history already exists')
+        return
+    logging.info('Creating index on "Date Added" column of risk history')
+    crsr.execute('CREATE INDEX DateAdded ON "Full Risk History" ("Date Added")')
+    crsr.commit()
+
+
 def main():
     setup_logging()
     logging.info(f'Database location: {CUR_PATH}\\full_risk_database.accdb')
@@ -104,75 +228,74 @@ def main():
         r'DRIVER={Microsoft Access Driver (*.mdb, *.accdb)};'
         f'DBQ={CUR_PATH}\\full_risk_database.accdb;'
     )
-    cnxn = pyodbc.connect(conn_str)
+    # run the whole update as a single transaction, committed at the end
+    cnxn = pyodbc.connect(conn_str, autocommit=False)
     crsr = cnxn.cursor()
-
-    columns = [c.column_name for c in crsr.columns(table="Full Risk History")]
-    logging.debug(f'  Columns in databse: {columns}')
+    # one cursor per insert statement, so the prepared statement is reused for every batch
+    latest_crsr = cnxn.cursor()
+    history_crsr = cnxn.cursor()
+    # send parameter arrays for executemany in one call instead of one round-trip per row
+    latest_crsr.fast_executemany = True
+    history_crsr.fast_executemany = True
+    latest_crsr.setinputsizes(LATEST_TYPES)
+    history_crsr.setinputsizes(HISTORY_TYPES)
+
+    if '--create-index' in sys.argv[1:]:
+        create_date_index(crsr)
 
     # delete entries younger than 2 weeks
     now_date = DATE_OVERWRITE or datetime.now().date()
     ref_data = now_date-timedelta(days=14)
     logging.debug('Deleting entreis from last 2 weeks and latest risks table')
-    crsr.execute('DELETE FROM "Full Risk History" WHERE DateValue("Date Added")>=?', ref_data)
+    crsr.execute('DELETE FROM "Full Risk History" WHERE "Date Added">=?', ref_data)
     crsr.execute('DELETE FROM "Latest Risks"')
 
-    for fname in glob(os.path.join(CUR_PATH, 'latest', '*Risks.xlsx')):
-        dcols, data = read_excel(fname)
-
-        insert_data = []
-
-        for i, di in enumerate(data):
-            try:
-                inst = di[0].upper().translate(RM_TABLE)[:3]
-                if len(inst)<3:
-                    inst = di[0].upper()[:3]
-                row = (now_date, di[0].upper(), tint(di[1]), f'{inst}-{tint(di[1]):02}', di[2], di[3],
-                       di[4], di[5], di[6], di[7], di[8],
-                       tdate(di[14]), di[15], tdate(di[16]),
-                       tint(di[17]), tint(di[18]), tint(di[19]), tint(di[20]), tint(di[21]), tint(di[22]), tint(di[24])
-                       )
-            except (AttributeError, ValueError, TypeError):
-                logging.warning(f'  error when parsing row {i+5}, check table')
-                logging.debug(f'    data: {di}')
-                check_row_entries(di)
-                logging.debug('    error message:', exc_info=True)
-                continue
+    logging.debug('Reading previous risk ratings')
+    history_map = {}
+    res = crsr.execute('SELECT Project, "Risk ID", "Risk Rating" FROM "Full Risk History" '
+                       'ORDER BY Project, "Risk ID", "Date Added" DESC')
+    for project, risk_id, rating in res.fetchall():
+        history_map.setdefault((project, risk_id), []).append(rating)
+
+    files = glob(os.path.join(CUR_PATH, 'latest', '*Risks.xlsx'))
+    # project name and instrument prefix are the same for most rows
+    inst_cache = {}
+    for fname, data in read_risk_files(files):
+        logging.debug(f'  found {len(data)} rows in {fname}')
+        rows = convert_rows(fname, data, now_date, inst_cache)
+        new_ratings = []
+        while True:
+            insert_data = list(islice(rows, BATCH_SIZE))
+            if not insert_data:
+                break
+            latest_data = []
+            for row in insert_data:
+                risk_history = history_map.get((row[1], row[2]), [])
+                try:
+                    prev_rating = risk_history[0]
+                except IndexError:
+                    prev_rating = -1
+                latest_data.append(row[1:]+(prev_rating, json.dumps(risk_history, separators=(',', ':'))))
+                new_ratings.append(((row[1], row[2]), row[-1]))
+
+            logging.debug(f'  inserting {len(insert_data)} lines into databse')
+            latest_crsr.executemany(f'INSERT INTO "Latest Risks" ({LATEST_COLUMNS}) '
+                                    'VALUES (?, ?, ?, ?, ?, '
+                                    '?, ?, ?, ?, ?, '
+                                    '?, ?, ?, '
+                                    '?, ?, ?, ?, ?, ?, ?,'
+                                    '?, ?)',
+                                    latest_data)
+            history_crsr.executemany(f'INSERT INTO "Full Risk History" ({HISTORY_COLUMNS}) '
+                                     'VALUES (?, ?, ?, ?, ?, ?, '
+                                     '?, ?, ?, ?, ?, '
+                                     '?, ?, ?, '
+                                     '?, ?, ?, ?, ?, ?, ?)',
+                                     insert_data)
+        # keep the history map in sync with the database for the following files
+        for key, rating in new_ratings:
+            history_map.setdefault(key, []).insert(0, rating)
 
-            insert_data.append(row)
-
-            res = crsr.execute('SELECT "Risk Rating" FROM "Full Risk History" WHERE Project=? AND "Risk ID"=? '
-                               'ORDER BY "Date Added" DESC',
-                               (row[1], row[2]))
-            risk_history = [fi[0] for fi in res.fetchall()]
-            try:
-                prev_rating = risk_history[0]
-            except IndexError:
-                prev_rating = -1
-            crsr.execute('INSERT INTO "Latest Risks"'
-                         '(Project, "Risk ID", "Global ID", "Risk Title", "Risk and Impact Description",'
-                         'Owner, Partner, Status, "Risk Treatment", "Past Treatment Actions and Notes", '
-                         '"Last Reviewed", "Planned Treatment Actions", "Action Due", '
-                         'when, cost, schedule, quality, "max impact", likelihood, "Risk Rating", '
-                         '"Last Rating", "Full History") '
-                         'VALUES (?, ?, ?, ?, ?, '
-                         '?, ?, ?, ?, ?, '
-                         '?, ?, ?, '
-                         '?, ?, ?, ?, ?, ?, ?,'
-                         '?, ?)',
-                         row[1:]+(prev_rating, repr(risk_history)))
-
-        logging.debug(f'  inserting {len(insert_data)} lines into databse')
-        crsr.executemany('INSERT INTO "Full Risk History"'
-                         '("Date Added", Project, "Risk ID", "Global ID", "Risk Title", "Risk and Impact Description",'
-                         'Owner, Partner, Status, "Risk Treatment", "Past Treatment Actions and Notes", '
-                         '"Last Reviewed", "Planned Treatment Actions", "Action Due", '
-                         'when, cost, schedule, quality, "max impact", likelihood, "Risk Rating") '
-                         'VALUES (?, ?, ?, ?, ?, ?, '
-                         '?, ?, ?, ?, ?, '
-                         '?, ?, ?, '
-                         '?, ?, ?, ?, ?, ?, ?)',
-                         insert_data)
     crsr.commit()
 
     if getattr(sys, 'frozen', False):